@@ -2,12 +2,131 @@
 Test models against a list of prompts and parameters.
 """
 
+import asyncio
+import hashlib
 import itertools
+import json
+import math
 import os
+import shutil
+import sqlite3
+import sys
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
 
 import click
 import ollama
+from click.core import ParameterSource
+
+# Instructions shared by every prompt. Keeping them at the start of the prompt
+# gives all requests an identical prefix that the OLLAMA server can reuse from
+# its prompt cache instead of processing it again.
+SYSTEM_PREFIX = ""
+
+# Seconds each request waits before it is sent, so the requests of all the
+# workers reach the server together and are processed in the same batch.
+BATCH_WINDOW = 0.005
+
+# How long the server keeps the model loaded after a request, -1 keeps it
+# loaded until it is stopped, so it is never unloaded during a run. It is
+# unloaded at the end of the run.
+KEEP_ALIVE = -1
+
+# Number of streamed tokens echoed between flushes of the output
+FLUSH_TOKENS = 16
+
+# Directory storing the result files by the hash of their request, shared by
+# all the runs so identical requests are only generated once
+RESULTS_STORE = "results"
+
+# Start of the response reused from a similar prompt
+SIMILAR_NOTE = (
+    "_Reused from the response to a similar prompt (similarity: {similarity:.3f})_"
+    "\n\n"
+)
+
+# Start of each result file, followed by the response
+RESULT_HEADER = "# Prompt\n{prompt}\n\n## Options\n{options}\n\n# Response\n"
+
+
+@dataclass
+class Job:
+    """
+    A prompt to test with a set of options.
+    """
+
+    prompt_test: str
+    options: dict
+    options_repr: str
+    test_result_file: str
+    stored_result_file: str
+
+
+def to_json(obj):
+    """
+    Serialize an object to canonical JSON, with sorted keys and no whitespace.
+
+    Used for hashes, cache keys and the output, so identical options always
+    produce the same text.
+
+    :param obj: The object to serialize.
+    """
+
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def result_key(model, options, prompt):
+    """
+    Return a hash identifying the response of a model to a prompt and options.
+
+    :param model: The OLLAMA model.
+    :param options: Options for the prompt.
+    :param prompt: The prompt sent to the model.
+    """
+
+    request = to_json({"m": model, "o": options, "p": prompt})
+    return hashlib.blake2b(request.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def link_result(stored_result_file, test_result_file):
+    """
+    Make a test result file point to its stored result file.
+
+    A relative symbolic link is used, falling back to a copy where symbolic
+    links are not available (e.g. Windows without the required privilege). An
+    existing test result file, from a run started in the same second, is
+    replaced.
+    """
+
+    # Remove the link itself, copying onto it would overwrite the stored file
+    if os.path.lexists(test_result_file):
+        os.remove(test_result_file)
+
+    target = os.path.relpath(stored_result_file, os.path.dirname(test_result_file))
+    try:
+        os.symlink(target, test_result_file)
+    except (NotImplementedError, OSError):
+        # On Windows the missing privilege is reported as WinError 1314, which
+        # does not map to a specific errno
+        shutil.copyfile(stored_result_file, test_result_file)
+
+
+def _read_file(entry):
+    fd = os.open(entry.path, os.O_RDONLY)
+    try:
+        chunks = [os.read(fd, entry.stat().st_size)]
+        # os.read can return less than requested, read until the end of the file
+        while chunks[-1]:
+            chunks.append(os.read(fd, 1 << 16))
+    finally:
+        os.close(fd)
+
+    # Translate newlines like reading in text mode does, so a checkout with
+    # CRLF line endings sends the same prompt
+    data = b"".join(chunks).decode("utf-8")
+    return data.replace("\r\n", "\n").replace("\r", "\n")
 
 
 def get_prompts(directory="prompts/"):
@@ -33,69 +152,474 @@ def get_prompts(directory="prompts/"):
     """
 
     prompts = {}
+    prompt_files = []
+
+    # Directory entries cache their type, so no extra stat call is needed
+    for group_entry in os.scandir(directory):
+        if group_entry.is_dir():
+            prompts[group_entry.name] = {}
 
-    for item in os.listdir(directory):
-        path = os.path.join(directory, item)
+            for file_entry in os.scandir(group_entry.path):
+                # Use the file name (without extension) as the key
+                file_name = os.path.splitext(file_entry.name)[0]
+                prompt_files.append((group_entry.name, file_name, file_entry))
 
-        if os.path.isdir(path):
-            prompts[item] = {}
+    # Read the files in parallel, the threads overlap waiting on the file system
+    with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 4) as executor:
+        contents = executor.map(_read_file, [entry for _, _, entry in prompt_files])
 
-            for file_path in os.scandir(path):
-                with open(file_path, encoding="utf-8") as f:
-                    # Use the file name (without extension) as the key
-                    file_name = os.path.splitext(file_path.name)[0]
-                    prompts[item][file_name] = f.read()
+        for (group_name, file_name, _), data in zip(prompt_files, contents):
+            prompts[group_name][file_name] = data
 
     return prompts
 
 
-def run_prompt(model, prompt_test, options, test_result_file):
+def sweep(minimum, maximum, increment):
+    """
+    Return the values from `minimum` to `maximum` (inclusive) in steps of `increment`.
+
+    Each value is computed from its step index instead of repeatedly adding the
+    increment, so floating point errors do not accumulate and drop the last value
+    (e.g. 0.1 to 0.3 in steps of 0.1).
+
+    :param minimum: First value.
+    :param maximum: Last value, included if it is a whole number of steps away.
+    :param increment: Difference between consecutive values.
+    """
+
+    # Round before flooring, so 2.9999999999999996 steps still count as 3
+    steps = math.floor(round((maximum - minimum) / increment, 9))
+    return [minimum + step * increment for step in range(steps + 1)]
+
+
+class PromptCache:
+    """
+    Cache of model responses stored in a SQLite database.
+
+    Responses are looked up by the exact (model, options, prompt) combination
+    first. When a similarity threshold is set, a response generated with the
+    same model and options for a prompt whose embedding has a cosine similarity
+    of at least `threshold` is returned instead.
+
+    :param path: Path of the SQLite database.
+    :param client: The OLLAMA async client used to compute embeddings.
+    :param embed_model: The OLLAMA model used to compute embeddings.
+    :param threshold: Minimum cosine similarity for a similar prompt to match,
+        `None` to only match identical prompts.
+    """
+
+    def __init__(self, path, client, embed_model="nomic-embed-text", threshold=None):
+        self.client = client
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.embeddings = {}
+
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, scope TEXT, embedding BLOB, response TEXT)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_scope ON responses (scope)"
+        )
+
+    @staticmethod
+    def _hash(*parts):
+        return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+    def _keys(self, model, options_repr, prompt):
+        # Responses can only be reused for the same model and options
+        return self._hash(model, options_repr, prompt), self._hash(model, options_repr)
+
+    async def _compute_embedding(self, prompt):
+        response = await self.client.embeddings(model=self.embed_model, prompt=prompt)
+        embedding = response["embedding"]
+        norm = math.sqrt(sum(x * x for x in embedding))
+        # A zero embedding has no direction to compare, it never matches
+        if norm == 0:
+            return None
+        return [x / norm for x in embedding]
+
+    async def _embed(self, prompt):
+        # The same prompt is used with many options, possibly at the same time,
+        # compute its embedding once
+        if prompt not in self.embeddings:
+            self.embeddings[prompt] = asyncio.ensure_future(
+                self._compute_embedding(prompt)
+            )
+        return await self.embeddings[prompt]
+
+    async def get(self, model, options_repr, prompt):
+        """
+        Return the cached response for a prompt and the similarity of the prompt
+        it was generated for, `None` if it was generated for this prompt.
+
+        Returns `(None, None)` if there is no cached response.
+        """
+
+        key, scope = self._keys(model, options_repr, prompt)
+        row = self.db.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None:
+            return row[0], None
+
+        if self.threshold is None:
+            return None, None
+
+        embedding = await self._embed(prompt)
+        if embedding is None:
+            return None, None
+
+        best_similarity, best_response = self.threshold, None
+        for stored, response in self.db.execute(
+            "SELECT embedding, response FROM responses "
+            "WHERE scope = ? AND embedding IS NOT NULL",
+            (scope,),
+        ):
+            similarity = sum(a * b for a, b in zip(embedding, array("d", stored)))
+            if similarity >= best_similarity:
+                best_similarity, best_response = similarity, response
+        if best_response is None:
+            return None, None
+        return best_response, best_similarity
+
+    async def set(self, model, options_repr, prompt, response):
+        """
+        Store the response generated for a prompt.
+        """
+
+        key, scope = self._keys(model, options_repr, prompt)
+        embedding = None
+        if self.threshold is not None:
+            embedding = await self._embed(prompt)
+            if embedding is not None:
+                embedding = array("d", embedding).tobytes()
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+            (key, scope, embedding, response),
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+async def run_prompt(
+    client,
+    model,
+    prompt_test,
+    options,
+    options_repr,
+    test_result_file,
+    output_file=None,
+    cache=None,
+    similar_result_file=None,
+    force=False,
+    stream_output=True,
+    prompt_processed=None,
+    batch_window=0,
+    load_model=None,
+):
     """
     Run an OLLAMA prompt and generate a response.
 
     This function takes in a model, a prompt to test, options for the prompt,
-    and a file path to save the test result. It uses the `ollama.generate`
-    method to generate responses from the prompt and saves the prompts, options,
-    and full response to the specified file.
+    and a file path to save the test result. It uses the `AsyncClient.generate`
+    method to stream the response from the prompt and writes the prompts, options,
+    and response to the specified file as it is generated. If a cache is given,
+    cached responses are used instead of calling the model.
+
+    A cached response generated for a similar prompt is not the result of this
+    prompt, it is written to `similar_result_file` instead, marked as reused.
 
+    :param client: The OLLAMA async client to use.
     :param model: The OLLAMA model to use.
     :param prompt_test: The prompt to test.
     :param options: Options for the prompt.
+    :param options_repr: The options serialized as canonical JSON, for the output
+        and the cache.
     :param test_result_file: The file path to save the test result.
+    :param output_file: The file path of the result shown in the output,
+        defaults to the file the result was saved to.
+    :param cache: Optional `PromptCache` of previous responses.
+    :param similar_result_file: The file path to save a response reused from a
+        similar prompt, defaults to `test_result_file`.
+    :param force: Generate the response even if it is cached.
+    :param stream_output: Echo the response while it is generated. Disable it
+        when prompts run concurrently, so their output does not interleave, the
+        response is then echoed once complete.
+    :param prompt_processed: Optional `asyncio.Event` set once the server has
+        processed the prompt and starts generating the response.
+    :param batch_window: Seconds to wait before sending the request, so it
+        reaches the server together with the requests of other workers.
+    :param load_model: Optional coroutine function awaited before calling the
+        model, to make sure it is loaded.
+    :return: The file path the result was saved to.
     """
 
-    stream = ollama.generate(
-        model=model,
-        prompt=prompt_test,
-        stream=True,
-        options=options,
-    )
+    prompt = SYSTEM_PREFIX + prompt_test
+
+    response = similarity = None
+    if cache is not None and not force:
+        response, similarity = await cache.get(model, options_repr, prompt)
+
+    if similarity is not None and similar_result_file is not None:
+        test_result_file = similar_result_file
+
+    if stream_output:
+        click.echo(f"Prompt: {prompt_test}")
+        click.echo("Options: ")
+        click.echo(options_repr)
+
+    # Write to a temporary file first, so an interrupted run does not leave a
+    # partial result that would be reused as complete
+    partial_result_file = f"{test_result_file}.partial"
+    try:
+        with open(partial_result_file, "w", buffering=1 << 16, encoding="utf-8") as f:
+            f.write(RESULT_HEADER.format(prompt=prompt_test, options=options_repr))
+
+            if response is not None:
+                if similarity is not None:
+                    f.write(SIMILAR_NOTE.format(similarity=similarity))
+                f.write(response)
+                if stream_output:
+                    if similarity is None:
+                        click.echo("Cached response")
+                    else:
+                        click.echo(SIMILAR_NOTE.format(similarity=similarity), nl=False)
+                    click.echo(response, nl=False)
+            else:
+                if load_model is not None:
+                    await load_model()
+                if batch_window:
+                    await asyncio.sleep(batch_window)
+                stream = await client.generate(
+                    model=model,
+                    prompt=prompt,
+                    stream=True,
+                    options=options,
+                    keep_alive=KEEP_ALIVE,
+                )
+
+                # Echo the tokens directly to stdout instead of through click, and
+                # only flush every few tokens
+                write = sys.stdout.write
+                flush = sys.stdout.flush
+
+                # The full response is only kept to store it in the cache, or to
+                # echo it once complete
+                keep_response = cache is not None or not stream_output
+                chunks = []
+                tokens = 0
+                async for chunk in stream:
+                    if prompt_processed is not None:
+                        prompt_processed.set()
+                    f.write(chunk["response"])
+                    if stream_output:
+                        write(chunk["response"])
+                        tokens += 1
+                        if tokens % FLUSH_TOKENS == 0:
+                            flush()
+                    if keep_response:
+                        chunks.append(chunk["response"])
+                if stream_output:
+                    flush()
+
+                response = "".join(chunks)
+                if cache is not None:
+                    await cache.set(model, options_repr, prompt, response)
+
+            f.write("\n")
+    except BaseException:
+        # Do not leave the partial result of a failed or cancelled request
+        os.remove(partial_result_file)
+        raise
+    os.replace(partial_result_file, test_result_file)
+
+    if not stream_output:
+        click.echo(f"Prompt: {prompt_test}")
+        click.echo("Options: ")
+        click.echo(options_repr)
+        if similarity is not None:
+            click.echo(SIMILAR_NOTE.format(similarity=similarity), nl=False)
+        click.echo(response)
+        click.echo(f"Saved to {output_file or test_result_file}")
+    click.echo("")
+    click.echo("---")
+    click.echo("")
+
+    return test_result_file
+
+
+async def run_prompts(
+    model,
+    jobs,
+    parallel,
+    cache_file=None,
+    cache_threshold=None,
+    embed_model=None,
+    force=False,
+    similar_results=None,
+):
+    """
+    Run all the prompt jobs concurrently.
 
-    click.echo("\n")
-    click.echo("Options: ")
-    click.echo(options)
-
-    full_response = ""
-    for chunk in iter(stream):
-        click.echo(chunk["response"], nl=False)
-        full_response = full_response + chunk["response"]
-
-    with open(test_result_file, "w", encoding="utf-8") as f:
-        f.write(
-            f"# Prompt\n"
-            f"{prompt_test}\n\n"
-            f"## Options\n"
-            f"{options}\n\n"
-            f"# Response\n"
-            f"{full_response}\n"
+    The jobs are queued and consumed by `parallel` workers, which should match
+    the number of requests the OLLAMA server processes in parallel
+    (`OLLAMA_NUM_PARALLEL`).
+
+    :param model: The OLLAMA model to use.
+    :param jobs: List of `Job` to run, in order.
+    :param parallel: Number of concurrent requests.
+    :param cache_file: Path of the response cache database, `None` to disable it.
+    :param cache_threshold: Minimum similarity to reuse the response of a
+        similar prompt, `None` to only reuse responses of identical prompts.
+    :param embed_model: The OLLAMA model used to compare prompts.
+    :param force: Generate the responses even if they are cached.
+    :param similar_results: Optional dictionary filled with the file paths of
+        the responses reused from similar prompts, by the stored result file of
+        their job. They are not stored.
+    """
+
+    client = ollama.AsyncClient()
+
+    # Load the model before the first request that needs it, so loading it is
+    # not counted in the first response, and keep it loaded during the run.
+    # An empty prompt only loads the model.
+    model_loaded = None
+    unload_model = False
+
+    async def load():
+        nonlocal unload_model
+        # Only unload the model after the run if it was not already loaded,
+        # e.g. by other clients of the server
+        running = await client.ps()
+        names = {running_model["name"] for running_model in running["models"]}
+        unload_model = model not in names and f"{model}:latest" not in names
+
+        click.echo(f"Loading model {model}")
+        await client.generate(model=model, prompt="", keep_alive=KEEP_ALIVE)
+
+    async def load_model():
+        nonlocal model_loaded
+        if model_loaded is None:
+            model_loaded = asyncio.ensure_future(load())
+        await model_loaded
+
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+
+    cache = None
+    if cache_file is not None:
+        cache = PromptCache(
+            cache_file, client, embed_model=embed_model, threshold=cache_threshold
         )
 
+    # The first request of each prompt is sent on its own, the other requests
+    # for that prompt wait until the server has processed it. They then find
+    # the prompt in the server cache and only generate their response.
+    prompts_processed = {}
+
+    if similar_results is None:
+        similar_results = {}
+
+    async def worker():
+        while not queue.empty():
+            job = queue.get_nowait()
+
+            prompt_processed = prompts_processed.get(job.prompt_test)
+            if prompt_processed is None:
+                prompt_processed = asyncio.Event()
+                prompts_processed[job.prompt_test] = prompt_processed
+            else:
+                await prompt_processed.wait()
+
+            try:
+                result_file = await run_prompt(
+                    client=client,
+                    model=model,
+                    prompt_test=job.prompt_test,
+                    options=job.options,
+                    options_repr=job.options_repr,
+                    test_result_file=job.stored_result_file,
+                    output_file=job.test_result_file,
+                    cache=cache,
+                    similar_result_file=job.test_result_file,
+                    force=force,
+                    # Only a single worker can echo the response without interleaving
+                    stream_output=parallel == 1,
+                    prompt_processed=prompt_processed,
+                    # A single worker has no other requests to be batched with
+                    batch_window=BATCH_WINDOW if parallel > 1 else 0,
+                    load_model=load_model,
+                )
+                if result_file != job.stored_result_file:
+                    similar_results[job.stored_result_file] = result_file
+            finally:
+                # Do not keep the other requests waiting if the response was
+                # cached or the request failed
+                prompt_processed.set()
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(parallel)))
+    finally:
+        if cache is not None:
+            cache.close()
+
+    # Unload the model after a successful run, it was kept loaded only for it
+    if unload_model:
+        try:
+            await client.generate(model=model, prompt="", keep_alive=0)
+        except Exception as e:
+            click.echo(f"Could not unload model {model}: {e}", err=True)
+
 
 @click.command()
 @click.option("--model", default="llama3.1", help="Model to test", show_default=True)
 @click.option("--group", default=None, help="Test group to run")
 @click.option("--seed", default=42, help="Random seed")
-@click.option("--num_predict", default=None, type=int, help="Max tokens to generate")
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Generate responses again even if a stored result exists",
+)
+@click.option(
+    "--parallel",
+    default=1,
+    type=click.IntRange(min=1),
+    envvar="OLLAMA_NUM_PARALLEL",
+    show_envvar=True,
+    help="Number of requests to run in parallel",
+    show_default=True,
+)
+@click.option(
+    "--num_predict",
+    default=256,
+    type=int,
+    help="Max tokens to generate, enough to compare parameters",
+    show_default=True,
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    help="Generate complete responses, ignoring --num_predict",
+)
+# Cache
+@click.option("--cache", default=None, help="Response cache database file")
+@click.option(
+    "--cache_threshold",
+    default=None,
+    type=click.FloatRange(-1, 1),
+    help="Reuse responses of prompts with at least this similarity (e.g. 0.95)",
+)
+@click.option(
+    "--embed_model",
+    default="nomic-embed-text",
+    help="Model used to compare prompts",
+    show_default=True,
+)
 # Temperature
 @click.option("--temp", default=1.0, type=float, help="Temperature", show_default=True)
 @click.option("--temp_min", default=None, type=float, help="Temperature min")
@@ -103,6 +627,7 @@ def run_prompt(model, prompt_test, options, test_result_file):
 @click.option(
     "--temp_inc",
     default=0.1,
+    type=click.FloatRange(min=0, min_open=True),
     help="How much should the temperature increase between min and max",
 )
 # Top_k
@@ -124,6 +649,7 @@ def run_prompt(model, prompt_test, options, test_result_file):
 @click.option(
     "--top_k_inc",
     default=1,
+    type=click.IntRange(min=1),
     help="How many should the top K increase between min and max",
 )
 # Top_p
@@ -145,14 +671,21 @@ def run_prompt(model, prompt_test, options, test_result_file):
 @click.option(
     "--top_p_inc",
     default=0.01,
-    type=float,
+    type=click.FloatRange(min=0, min_open=True),
     help="How much should the top P increase between min and max",
 )
 def start(
     model,
     group,
     seed,
+    force,
+    parallel,
     num_predict,
+    full,
+    # Cache
+    cache,
+    cache_threshold,
+    embed_model,
     # Temperature
     temp,
     temp_min,
@@ -172,87 +705,86 @@ def start(
     """
     Start the tests with the specified parameters
     """
+    if cache is None:
+        if cache_threshold is not None:
+            raise click.UsageError("--cache_threshold requires --cache")
+        ctx = click.get_current_context()
+        if ctx.get_parameter_source("embed_model") != ParameterSource.DEFAULT:
+            raise click.UsageError("--embed_model requires --cache")
+
     click.echo("Selected options:")
     click.echo(f"  Model: {model}")
     click.echo(f"  Random seed: {seed}")
+    if full:
+        num_predict = None
     click.echo(f"  Max tokens: {num_predict}")
+    click.echo(f"  Parallel requests: {parallel}")
 
     if temp_min is not None and temp_max is not None:
-        temperature_values = []
-        t = temp_min
-        while t <= temp_max:
-            temperature_values.append(round(t, 2))
-            t = t + temp_inc
+        temperature_values = [round(t, 2) for t in sweep(temp_min, temp_max, temp_inc)]
     else:
         temperature_values = [temp]
     click.echo(f"  Temperatures: {temperature_values}")
 
     if top_k_min is not None and top_k_max is not None:
-        top_k_values = []
-        k = top_k_min
-        while k <= top_k_max:
-            top_k_values.append(k)
-            k = k + top_k_inc
+        top_k_values = sweep(top_k_min, top_k_max, top_k_inc)
     else:
         top_k_values = [top_k]
     click.echo(f"  Top K values: {top_k_values}")
 
     if top_p_min is not None and top_p_max is not None:
-        top_p_values = []
-        p = top_p_min
-        while p <= top_p_max:
-            top_p_values.append(round(p, 2))
-            p = p + top_p_inc
+        top_p_values = [round(p, 2) for p in sweep(top_p_min, top_p_max, top_p_inc)]
     else:
         top_p_values = [top_p]
     click.echo(f"  Top P values: {top_p_values}")
 
+    # The options do not depend on the group, build them once
+    base_options = {
+        "seed": seed,
+        "num_predict": num_predict,
+    }
+    all_options = (
+        {**base_options, "temperature": t, "top_k": k, "top_p": p}
+        for t, k, p in itertools.product(temperature_values, top_k_values, top_p_values)
+    )
+    # Rounded sweep values can repeat (e.g. an increment of 0.001 rounded to 2
+    # decimals), only test each combination once. The options are keyed by
+    # their canonical JSON, which is also used as their cache key.
+    test_options = {to_json(options): options for options in all_options}
+
     # Read prompts
     prompts = get_prompts()
 
     current_timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     results_directory = f"results_{current_timestamp}"
-    os.mkdir(results_directory)
 
+    jobs = []
     for group_name, group_prompt_test in prompts.items():
         # Filter group test
         if group is not None and group_name != group:
             continue
 
-        test_group_directory = results_directory + "/" + group_name
-        os.mkdir(test_group_directory)
-
-        base_options = {
-            "seed": seed,
-            "num_predict": num_predict,
-        }
-        test_options = []
-        all_combinations = itertools.product(
-            temperature_values, top_k_values, top_p_values
-        )
-        for combination in all_combinations:
-            new_option = dict(base_options)
-            (
-                new_option["temperature"],
-                new_option["top_k"],
-                new_option["top_p"],
-            ) = combination
-            test_options.append(new_option)
+        test_group_directory = os.path.join(results_directory, group_name)
 
         for prompt_test, prompt_contents in group_prompt_test.items():
-            click.echo(f"Prompt: {prompt_contents}")
+            test_result_prefix = os.path.join(test_group_directory, prompt_test)
 
             # Iterate options
-            for option_index, options in enumerate(test_options):
-                test_result_file = (
-                    f"{test_group_directory}/{prompt_test}_{option_index}"
-                )
-
-                run_prompt(
-                    model=model,
-                    prompt_test=prompt_contents,
-                    options=options,
-                    test_result_file=test_result_file,
+            for option_index, (options_repr, options) in enumerate(
+                test_options.items()
+            ):
+                test_result_file = f"{test_result_prefix}_{option_index}"
+
+                key = result_key(model, options, SYSTEM_PREFIX + prompt_contents)
+
+                jobs.append(
+                    Job(
+                        prompt_test=prompt_contents,
+                        options=options,
+                        options_repr=options_repr,
+                        test_result_file=test_result_file,
+                        stored_result_file=os.path.join(RESULTS_STORE, f"{key}.md"),
+                    )
                 )
 
             # Iterate runtime options
@@ -270,9 +802,51 @@ def start(
             # mirostat_tau: float
             # mirostat_eta: float
 
-            click.echo("")
-            click.echo("---")
-            click.echo("")
+    # Create all the result directories before running the prompts
+    result_directories = {os.path.dirname(job.test_result_file) for job in jobs}
+    for directory in [RESULTS_STORE, *result_directories]:
+        os.makedirs(directory, exist_ok=True)
+
+    # Only generate each stored result once, and skip the ones generated by
+    # previous runs
+    pending_jobs = {}
+    for job in jobs:
+        if force or not os.path.exists(job.stored_result_file):
+            pending_jobs.setdefault(job.stored_result_file, job)
+    pending_jobs = list(pending_jobs.values())
+    click.echo(f"  Stored results reused: {len(jobs) - len(pending_jobs)}")
+
+    # Send identical prompts one after another so the server can reuse the
+    # already processed prompt from its cache
+    pending_jobs.sort(key=lambda job: job.prompt_test)
+
+    similar_results = {}
+    try:
+        asyncio.run(
+            run_prompts(
+                model=model,
+                jobs=pending_jobs,
+                parallel=parallel,
+                cache_file=cache,
+                cache_threshold=cache_threshold,
+                embed_model=embed_model,
+                force=force,
+                similar_results=similar_results,
+            )
+        )
+    finally:
+        # Link the completed results, even if the run failed
+        for job in jobs:
+            similar_result_file = similar_results.get(job.stored_result_file)
+            if similar_result_file is None:
+                if os.path.exists(job.stored_result_file):
+                    link_result(job.stored_result_file, job.test_result_file)
+            elif similar_result_file != job.test_result_file:
+                # Responses reused from a similar prompt are not stored, copy
+                # them to the identical jobs, replacing the link of a previous run
+                if os.path.lexists(job.test_result_file):
+                    os.remove(job.test_result_file)
+                shutil.copyfile(similar_result_file, job.test_result_file)
 
 
 if __name__ == "__main__":